@@ -1,9 +1,26 @@
-import json
 import logging
+
+import msgspec
+import orjson
 from aiohttp import web
+from aiohttp.multipart import BodyPartReader
 
 from app.service.auth_svc import for_all_public_methods, check_authorization
-from plugins.stixmapper.app.stixmapper_svc import StixmapperService
+from plugins.stixmapper.app.stixmapper_svc import StixBundle, StixMatchRequest, StixmapperService, is_stix_bundle
+
+MAX_BUNDLE_BYTES = 64 * 1024 * 1024
+READ_CHUNK_BYTES = 65536
+
+
+def _json_response(payload, status=200):
+    return web.Response(body=msgspec.json.encode(payload), status=status, content_type='application/json')
+
+
+def _decode_json(raw, struct_type):
+    try:
+        return msgspec.json.decode(raw, type=struct_type)
+    except msgspec.ValidationError:
+        return orjson.loads(raw)
 
 
 @for_all_public_methods(check_authorization)
@@ -18,8 +35,8 @@ class StixmapperAPI:
 
     async def mirror(self, request):
         raw = await request.read()
-        body = json.loads(raw.decode('utf-8')) if raw else {}
-        return web.json_response(body)
+        body = orjson.loads(raw) if raw else {}
+        return _json_response(body)
 
     async def match_stix(self, request):
         """
@@ -28,6 +45,13 @@ class StixmapperAPI:
           - multipart/form-data (file, stix, bundle, upload)
           - raw JSON body
         """
+        limit = self._body_limit(request)
+        if request.content_length is not None and request.content_length > limit:
+            return _json_response(
+                {'status': 'error', 'error': 'STIX bundle too large'},
+                status=413
+            )
+
         try:
             stix_bundle = None
             options = {
@@ -38,26 +62,32 @@ class StixmapperAPI:
             # ---- multipart/form-data ----
             if request.content_type and request.content_type.startswith('multipart/'):
                 reader = await request.multipart()
+                budget = limit
                 async for part in reader:
+                    if not isinstance(part, BodyPartReader):
+                        continue
+                    raw = await self._read_capped(part.read_chunk, budget)
+                    budget -= len(raw)
                     if part.name in ('file', 'stix', 'bundle', 'upload'):
-                        raw = await part.read()
-                        stix_bundle = json.loads(raw.decode('utf-8'))
+                        stix_bundle = _decode_json(raw, StixBundle)
                     elif part.name == 'options':
-                        raw = await part.read()
-                        options.update(json.loads(raw.decode('utf-8')))
+                        options.update(orjson.loads(raw))
 
             # ---- application/json ----
             else:
-                raw = await request.read()
+                raw = await self._read_capped(request.content.read, limit)
                 if raw:
-                    body = json.loads(raw.decode('utf-8'))
-                    if isinstance(body, dict):
+                    body = _decode_json(raw, StixMatchRequest)
+                    if isinstance(body, StixMatchRequest):
+                        options.update(body.options or {})
+                        stix_bundle = body.stix if is_stix_bundle(body.stix) else body
+                    elif isinstance(body, dict):
                         options.update(body.get('options', {}))
                         stix_bundle = body.get('stix') or body
 
             # ---- validation ----
-            if not isinstance(stix_bundle, dict) or stix_bundle.get('type') != 'bundle':
-                return web.json_response(
+            if not is_stix_bundle(stix_bundle):
+                return _json_response(
                     {'status': 'error', 'error': 'Invalid STIX bundle'},
                     status=400
                 )
@@ -68,17 +98,41 @@ class StixmapperAPI:
                 filter_by_tactic=options.get('filter_by_tactic', False)
             )
 
-            return web.json_response({'status': 'success', 'data': results})
+            return _json_response({'status': 'success', 'data': results})
+
+        except web.HTTPRequestEntityTooLarge:
+            return _json_response(
+                {'status': 'error', 'error': 'STIX bundle too large'},
+                status=413
+            )
 
-        except json.JSONDecodeError:
-            return web.json_response(
+        except (orjson.JSONDecodeError, ValueError):
+            return _json_response(
                 {'status': 'error', 'error': 'Invalid JSON'},
                 status=400
             )
 
         except Exception:
             self.log.exception('STIX mapping failed')
-            return web.json_response(
+            return _json_response(
                 {'status': 'error', 'error': 'STIX processing failed'},
                 status=500
             )
+
+    @staticmethod
+    def _body_limit(request):
+        if request.client_max_size:
+            return min(MAX_BUNDLE_BYTES, request.client_max_size)
+        return MAX_BUNDLE_BYTES
+
+    @staticmethod
+    async def _read_capped(read_chunk, limit):
+        buf = bytearray()
+        while True:
+            chunk = await read_chunk(READ_CHUNK_BYTES)
+            if not chunk:
+                break
+            buf.extend(chunk)
+            if len(buf) > limit:
+                raise web.HTTPRequestEntityTooLarge(max_size=limit, actual_size=len(buf))
+        return buf
@@ -1,9 +1,88 @@
 import re
+import time
+import asyncio
+import heapq
 import logging
-from typing import Dict, List, Optional, Set, Any
+import operator
+from typing import Callable, Dict, List, Optional, Set, Any, Tuple, Union
 
-MITRE_TECH_ID_RE = re.compile(r"^(?P<tech>T\d{4})(?:\.(?P<sub>\d{3}))?$", re.IGNORECASE)
-MITRE_URL_ID_RE = re.compile(r"/techniques/(?P<tech_id>T\d{4})(?:/(?P<sub>\d{3}))?", re.IGNORECASE)
+import msgspec
+
+MITRE_URL_ID_RE = re.compile(r"/techniques/(?P<tech_id>t\d{4})(?:/(?P<sub>\d{3}))?")
+ABILITY_INDEX_TTL = 30
+MAP_YIELD_INTERVAL = 256
+
+_ABILITY_FIELDS = operator.attrgetter('ability_id', 'name', 'tactic', 'technique')
+
+
+class ExternalReference(msgspec.Struct):
+    source_name: Optional[str] = None
+    external_id: Optional[str] = None
+    url: Optional[str] = None
+
+
+class KillChainPhase(msgspec.Struct):
+    kill_chain_name: Optional[str] = None
+    phase_name: Optional[str] = None
+
+
+class StixObject(msgspec.Struct):
+    type: Optional[str] = None
+    id: Optional[str] = None
+    name: Optional[str] = None
+    external_references: Optional[List[ExternalReference]] = None
+    kill_chain_phases: Optional[List[KillChainPhase]] = None
+
+
+class StixBundle(msgspec.Struct):
+    type: Optional[str] = None
+    objects: Optional[List[StixObject]] = None
+
+
+class StixMatchRequest(StixBundle):
+    stix: Optional[StixBundle] = None
+    options: Optional[Dict[str, Any]] = None
+
+
+class AbilityTechnique(msgspec.Struct, frozen=True):
+    attack_id: Optional[str] = None
+    name: Optional[str] = None
+
+
+class AbilityOut(msgspec.Struct, frozen=True):
+    ability_id: Optional[str] = None
+    name: Optional[str] = None
+    tactic: Optional[str] = None
+    technique: AbilityTechnique = msgspec.field(default_factory=AbilityTechnique)
+
+
+AbilityIndex = Tuple[
+    Dict[str, Tuple[AbilityOut, ...]],
+    Dict[Tuple[str, str], Tuple[Tuple[int, AbilityOut], ...]]
+]
+
+
+def _getattr_or_none(obj: Any, key: str) -> Any:
+    return getattr(obj, key, None)
+
+
+def _field_getter(obj: Any) -> Callable[[Any, str], Any]:
+    return dict.get if isinstance(obj, dict) else _getattr_or_none
+
+
+def _is_technique_id(s: str) -> bool:
+    n = len(s)
+    if n == 5:
+        return s[0] == 'T' and s[1:].isdecimal()
+    if n == 9:
+        return s[0] == 'T' and s[1:5].isdecimal() and s[5] == '.' and s[6:].isdecimal()
+    return False
+
+
+def is_stix_bundle(obj: Any) -> bool:
+    if isinstance(obj, StixBundle):
+        return obj.type == 'bundle'
+    return isinstance(obj, dict) and obj.get('type') == 'bundle'
 
 
 class StixmapperService:
@@ -15,135 +94,205 @@ class StixmapperService:
             if services.get('app_svc')
             else logging.getLogger('stixmapper_svc')
         )
+        self._ability_index_cache = (0.0, -1, {}, {})
 
     async def match_stix_to_abilities(
         self,
-        stix_bundle: Dict,
+        stix_bundle: Union[StixBundle, Dict],
         fallback_to_parent: bool = True,
         filter_by_tactic: bool = False
-    ) -> Dict:
-        if not isinstance(stix_bundle, dict) or stix_bundle.get('type') != 'bundle':
+    ) -> Dict[str, Any]:
+        """
+        Maps each attack-pattern in a STIX bundle to CALDERA abilities.
+        Each mapping's "abilities" is a list of frozen AbilityOut structs shared with
+        the ability index; use msgspec.to_builtins(result) for plain dicts.
+        """
+        if not is_stix_bundle(stix_bundle):
             raise ValueError("Expected a STIX bundle object with type='bundle'")
 
-        objs = stix_bundle.get('objects') or []
-        attack_patterns = [
-            o for o in objs
-            if isinstance(o, dict) and o.get('type') == 'attack-pattern'
-        ]
+        if isinstance(stix_bundle, StixBundle):
+            objs = stix_bundle.objects or []
+        else:
+            objs = stix_bundle.get('objects') or []
+        index = await self._abilities_index()
 
         mappings: List[Dict] = []
+        ap_count = 0
         ap_with_tech = 0
         total_abilities = 0
 
-        for ap in attack_patterns:
-            ap_id = ap.get('id')
-            ap_name = ap.get('name')
-            tactics = self._extract_mitre_tactics(ap)
-            technique_id = self._extract_mitre_technique_id(ap)
-
-            abilities: List[Dict] = []
-            parent_technique_id = None
+        for ap in objs:
+            if isinstance(ap, dict):
+                if ap.get('type') != 'attack-pattern':
+                    continue
+                try:
+                    typed_ap = msgspec.convert(ap, StixObject)
+                except msgspec.ValidationError as e:
+                    self.log.warning('Malformed attack-pattern %s, reporting it without a technique: %s',
+                                     ap.get('id'), e)
+                    mapping = {
+                        "attack_pattern_id": ap.get('id'),
+                        "name": ap.get('name'),
+                        "technique_id": None,
+                        "tactics": [],
+                        "abilities": []
+                    }
+                else:
+                    mapping = self._map_attack_pattern(typed_ap, index, fallback_to_parent, filter_by_tactic)
+            elif isinstance(ap, StixObject) and ap.type == 'attack-pattern':
+                mapping = self._map_attack_pattern(ap, index, fallback_to_parent, filter_by_tactic)
+            else:
+                continue
 
-            if technique_id:
+            ap_count += 1
+            if mapping["technique_id"]:
                 ap_with_tech += 1
-                abilities = await self._find_abilities_for_attack_id(technique_id)
-
-                if not abilities and fallback_to_parent and '.' in technique_id:
-                    parent_technique_id = technique_id.split('.', 1)[0].upper()
-                    abilities = await self._find_abilities_for_attack_id(parent_technique_id)
+            total_abilities += len(mapping["abilities"])
+            mappings.append(mapping)
 
-                if filter_by_tactic and tactics and abilities:
-                    tactic_set = set(tactics)
-                    abilities = [a for a in abilities if a.get('tactic') in tactic_set]
-
-                total_abilities += len(abilities)
-
-            mappings.append({
-                "attack_pattern_id": ap_id,
-                "name": ap_name,
-                "technique_id": technique_id,
-                **({"parent_technique_id": parent_technique_id} if parent_technique_id else {}),
-                "tactics": tactics,
-                "abilities": abilities
-            })
+            if ap_count % MAP_YIELD_INTERVAL == 0:
+                await asyncio.sleep(0)
 
+        self.log.debug('Mapped %d attack-patterns (%d with technique, %d abilities)',
+                       ap_count, ap_with_tech, total_abilities)
         return {
             "mappings": mappings,
             "stats": {
-                "attack_patterns": len(attack_patterns),
+                "attack_patterns": ap_count,
                 "with_technique": ap_with_tech,
                 "abilities_found": total_abilities
             }
         }
 
-    def _extract_mitre_technique_id(self, ap: Dict) -> Optional[str]:
-        refs = ap.get("external_references") or []
+    def _map_attack_pattern(
+        self,
+        ap: StixObject,
+        index: AbilityIndex,
+        fallback_to_parent: bool,
+        filter_by_tactic: bool
+    ) -> Dict:
+        by_technique, by_technique_tactic = index
+        tactics = self._extract_mitre_tactics(ap)
+        technique_id = self._extract_mitre_technique_id(ap)
 
-        for ref in refs:
-            if (ref.get("source_name") or "").lower() == "mitre-attack":
-                ext_id = (ref.get("external_id") or "").strip()
-                if ext_id and MITRE_TECH_ID_RE.match(ext_id):
-                    return ext_id.upper()
-
-                url = ref.get("url") or ""
-                m = MITRE_URL_ID_RE.search(url)
-                if m:
-                    tech = m.group("tech_id").upper()
-                    sub = m.group("sub")
-                    return f"{tech}.{sub}" if sub else tech
+        abilities: List[AbilityOut] = []
+        parent_technique_id = None
+
+        if technique_id:
+            matched_id = technique_id
+            if fallback_to_parent and '.' in technique_id and technique_id not in by_technique:
+                parent_technique_id = technique_id.split('.', 1)[0]
+                matched_id = parent_technique_id
+
+            if filter_by_tactic and tactics:
+                buckets = (
+                    by_technique_tactic.get((matched_id, tactic), ())
+                    for tactic in dict.fromkeys(t.lower() for t in tactics)
+                )
+                abilities = [a for _, a in heapq.merge(*buckets)]
+            else:
+                abilities = list(by_technique.get(matched_id, ()))
+
+        return {
+            "attack_pattern_id": ap.id,
+            "name": ap.name,
+            "technique_id": technique_id,
+            **({"parent_technique_id": parent_technique_id} if parent_technique_id else {}),
+            "tactics": tactics,
+            "abilities": abilities
+        }
+
+    def _extract_mitre_technique_id(self, ap: StixObject) -> Optional[str]:
+        refs = ap.external_references or []
+        url_fallback = None
 
         for ref in refs:
-            url = ref.get("url") or ""
-            m = MITRE_URL_ID_RE.search(url)
-            if m:
-                tech = m.group("tech_id").upper()
-                sub = m.group("sub")
-                return f"{tech}.{sub}" if sub else tech
+            if (ref.source_name or "").lower() == "mitre-attack":
+                ext_id = (ref.external_id or "").strip().upper()
+                if _is_technique_id(ext_id):
+                    return ext_id
+
+                tech = self._technique_from_url(ref.url)
+                if tech:
+                    return tech
+            elif url_fallback is None:
+                url_fallback = self._technique_from_url(ref.url)
 
-        return None
+        return url_fallback
 
-    def _extract_mitre_tactics(self, ap: Dict) -> List[str]:
-        phases = ap.get("kill_chain_phases") or []
+    def _technique_from_url(self, url: Optional[str]) -> Optional[str]:
+        url = (url or "").lower()
+        if "/techniques/t" not in url:
+            return None
+        m = MITRE_URL_ID_RE.search(url)
+        if not m:
+            return None
+        tech = m.group("tech_id").upper()
+        sub = m.group("sub")
+        return f"{tech}.{sub}" if sub else tech
+
+    def _extract_mitre_tactics(self, ap: StixObject) -> List[str]:
+        phases = ap.kill_chain_phases or []
         tactics: Set[str] = set()
         for p in phases:
-            if (p.get("kill_chain_name") or "").lower() == "mitre-attack":
-                ph = (p.get("phase_name") or "").strip()
+            if (p.kill_chain_name or "").lower() == "mitre-attack":
+                ph = (p.phase_name or "").strip()
                 if ph:
                     tactics.add(ph)
         return sorted(tactics)
 
-    async def _find_abilities_for_attack_id(self, attack_id: str) -> List[Dict]:
-        all_abilities = await self.data_svc.locate('abilities', match=dict())
-
-        matched: List[Dict] = []
-        for a in all_abilities or []:
-            tech = self._get(a, ["technique"]) or {}
-            ability_attack_id = (
-                tech.get("attack_id") if isinstance(tech, dict)
-                else getattr(tech, "attack_id", None)
-            )
-            tech_name = (
-                tech.get("name") if isinstance(tech, dict)
-                else getattr(tech, "name", None)
-            )
-
-            if (ability_attack_id or "").upper() == attack_id.upper():
-                matched.append({
-                    "ability_id": self._get(a, ["ability_id"]) or self._get(a, ["id"]),
-                    "name": self._get(a, ["name"]),
-                    "tactic": self._get(a, ["tactic"]),
-                    "technique": {
-                        "attack_id": ability_attack_id,
-                        "name": tech_name
-                    }
-                })
+    async def _abilities_index(self) -> AbilityIndex:
+        all_abilities = await self.data_svc.locate('abilities', match=dict()) or []
+        built_at, count, by_technique, by_technique_tactic = self._ability_index_cache
+        if count == len(all_abilities) and time.monotonic() - built_at < ABILITY_INDEX_TTL:
+            return by_technique, by_technique_tactic
 
-        return matched
+        by_technique = {}
+        by_technique_tactic = {}
+        for a in all_abilities:
+            ability = self._ability_out(a)
+            ability_attack_id = ability.technique.attack_id
+            if ability_attack_id:
+                key = ability_attack_id.upper()
+                tactic = (ability.tactic or "").lower()
+                bucket = by_technique.setdefault(key, [])
+                by_technique_tactic.setdefault((key, tactic), []).append((len(bucket), ability))
+                bucket.append(ability)
 
-    def _get(self, obj: Any, path: List[str], default: Any = None) -> Any:
-        cur: Any = obj
-        for key in path:
-            cur = cur.get(key) if isinstance(cur, dict) else getattr(cur, key, None)
-            if cur is None:
-                return default
-        return cur
+        by_technique = {k: tuple(v) for k, v in by_technique.items()}
+        by_technique_tactic = {k: tuple(v) for k, v in by_technique_tactic.items()}
+        self._ability_index_cache = (time.monotonic(), len(all_abilities), by_technique, by_technique_tactic)
+        self.log.debug('Rebuilt ability index: %d abilities across %d techniques',
+                       len(all_abilities), len(by_technique))
+        return by_technique, by_technique_tactic
+
+    def _ability_out(self, a: Any) -> AbilityOut:
+        try:
+            ability_id, name, tactic, tech = _ABILITY_FIELDS(a)
+            ability_id = ability_id or getattr(a, "id", None)
+        except AttributeError:
+            get = _field_getter(a)
+            ability_id = get(a, "ability_id") or get(a, "id")
+            name = get(a, "name")
+            tactic = get(a, "tactic")
+            tech = get(a, "technique")
+
+        tech = tech or {}
+        tech_get = _field_getter(tech)
+        attack_id = tech_get(tech, "attack_id")
+        tech_name = tech_get(tech, "name")
+        if not attack_id:
+            get = _field_getter(a)
+            attack_id = get(a, "technique_id")
+            tech_name = get(a, "technique_name")
+
+        return AbilityOut(
+            ability_id=ability_id,
+            name=name,
+            tactic=tactic,
+            technique=AbilityTechnique(attack_id=attack_id, name=tech_name)
+        )
+
+    async def _find_abilities_for_attack_id(self, attack_id: str) -> List[Dict]:
+        by_technique, _ = await self._abilities_index()
+        return msgspec.to_builtins(list(by_technique.get(attack_id.upper(), ())))